@@ -1,3 +1,5 @@
+import functools
+import io
 import pandas as pd
 from sqlalchemy import create_engine, text
 import numpy as np
@@ -8,12 +10,131 @@ import re
 from typing import Dict, Any, List, Optional
 from datetime import datetime
 
+# Formats tried in order; '%d/%m/%Y' covers CSVs written before dates were emitted as ISO
+DATETIME_FORMATS = {
+    'date': ('%Y-%m-%d', '%d/%m/%Y'),
+    'time': ('%H:%M:%S',)
+}
+
+def _prepare_datetime(df: pd.DataFrame, field_name: str, field_format: str) -> None:
+    values = df[field_name]
+    if values.dtype == object:
+        values = values.str.strip()
+    
+    formats = DATETIME_FORMATS[field_format]
+    parsed = pd.to_datetime(values, format=formats[0], cache=True, errors='coerce')
+    for fallback in formats[1:]:
+        missing = parsed.isna() & values.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(values[missing], format=fallback, cache=True, errors='coerce')
+    
+    unparsed = parsed.isna() & values.notna()
+    if unparsed.any():
+        print(f"Warning: {unparsed.sum()} value(s) in '{field_name}' did not match {formats} and were set to NULL, "
+              f"e.g. {values[unparsed].iloc[0]!r}")
+    
+    df[field_name] = parsed.dt.date if field_format == 'date' else parsed.dt.time
+
+def _prepare_date(df: pd.DataFrame, field_name: str, field_info: Dict) -> None:
+    _prepare_datetime(df, field_name, 'date')
+
+def _prepare_time(df: pd.DataFrame, field_name: str, field_info: Dict) -> None:
+    _prepare_datetime(df, field_name, 'time')
+
+def _prepare_array(df: pd.DataFrame, field_name: str, field_info: Dict) -> None:
+    values = df[field_name]
+    raw = values.to_numpy(dtype=object)
+    is_list = values.map(type).eq(list).to_numpy()
+    is_null = ~is_list & values.isna().to_numpy()
+    is_json = ~is_list & ~is_null & values.astype(str).str.lstrip().str.startswith('[').to_numpy()
+    is_scalar = ~(is_list | is_null | is_json)
+    
+    result = np.empty(len(raw), dtype=object)
+    result[is_list] = raw[is_list]
+    result[is_json] = pd.Series([json.loads(x) for x in raw[is_json]], dtype=object).to_numpy()
+    result[is_scalar] = pd.Series([[x] for x in raw[is_scalar]], dtype=object).to_numpy()
+    result[is_null] = pd.Series([[] for _ in range(is_null.sum())], dtype=object).to_numpy()
+    df[field_name] = pd.Series(result, index=values.index)
+
+def _prepare_bool(df: pd.DataFrame, field_name: str, field_info: Dict) -> None:
+    df[field_name] = (
+        df[field_name].astype(str).str.lower()
+        .map({'true': True, 'false': False})
+        .astype('boolean')
+    )
+
+def _prepare_num(df: pd.DataFrame, field_name: str, field_info: Dict) -> None:
+    values = pd.to_numeric(df[field_name], errors='coerce')
+    if str(field_info.get('type', '')).lower() == 'integer':
+        # Gaps make the column float64, and COPY rejects '1.0' for INTEGER columns.
+        # Round like Postgres' numeric-to-integer cast did on the old INSERT path.
+        values = values.round().astype('Int64')
+    df[field_name] = values
+
+def _prepare_enum(df: pd.DataFrame, field_name: str, field_info: Dict) -> None:
+    enum_values = field_info['enum']
+    values = df[field_name]
+    df[field_name] = values.where(values.isin(enum_values), enum_values[0])
+
+_HANDLERS = {
+    'date': _prepare_date,
+    'time': _prepare_time,
+    'array': _prepare_array,
+    'bool': _prepare_bool,
+    'num': _prepare_num,
+    'enum': _prepare_enum
+}
+
+@functools.lru_cache(maxsize=8)
+def _load_schema(schema_path: str, mtime_ns: int, size: int) -> Dict:
+    # mtime and size are part of the cache key so edited schemas are reloaded
+    return json.loads(Path(schema_path).read_bytes())
+
 class SchemaParser:
     def __init__(self, schema_path: str):
-        with open(schema_path, 'r', encoding='utf-8') as f:
-            self.schema = json.load(f)
+        stat = Path(schema_path).stat()
+        self.schema = _load_schema(str(schema_path), stat.st_mtime_ns, stat.st_size)
+        
+        self._fields = self._build_field_definitions()
+        self._field_types = {name: self.get_field_type(info) for name, info in self._fields.items()}
+        self._formats = {name: info.get('format', '') for name, info in self._fields.items()}
+        self._enums = {name: self.get_enum_values(info) for name, info in self._fields.items()}
+        self._kinds = {name: self._kinds_for(name) for name in self._fields}
     
     def get_field_definitions(self) -> Dict[str, Dict]:
+        return self._fields
+    
+    def get_field_kinds(self, field_name: str) -> tuple:
+        return self._kinds[field_name]
+    
+    def get_csv_dtypes(self) -> Dict[str, type]:
+        # Read string and enum fields as text so every chunk parses them the same way
+        return {
+            name: str for name in self._fields
+            if self._field_types[name] == 'string' or self._enums[name]
+        }
+    
+    def _kinds_for(self, field_name: str) -> tuple:
+        field_type = self._field_types[field_name]
+        field_format = self._formats[field_name]
+        
+        if field_format in ('date', 'time'):
+            kinds = (field_format,)
+        elif field_type == 'array':
+            kinds = ('array',)
+        elif field_type == 'boolean':
+            kinds = ('bool',)
+        elif field_type in ['number', 'integer']:
+            kinds = ('num',)
+        else:
+            kinds = ()
+        
+        if self._enums[field_name]:
+            kinds += ('enum',)
+        return kinds
+    
+    def _build_field_definitions(self) -> Dict[str, Dict]:
         metadata_fields = {
             "date": {
                 "type": "string",
@@ -160,43 +281,50 @@ class GenericDatabaseLoader:
     def prepare_data(self, df: pd.DataFrame, schema_parser: SchemaParser) -> pd.DataFrame:
         field_definitions = schema_parser.get_field_definitions()
         
+        plan = []
         for field_name, field_info in field_definitions.items():
             if field_name not in df.columns:
                 if field_info.get('required', False):
                     raise ValueError(f"Required field '{field_name}' not found in CSV")
                 continue
-            
-            field_type = schema_parser.get_field_type(field_info)
-            field_format = field_info.get('format', '')
-            
+            for kind in schema_parser.get_field_kinds(field_name):
+                plan.append((field_name, _HANDLERS[kind], field_info))
+        
+        for field_name, handler, field_info in plan:
             try:
-                if field_format == 'date':
-                    df[field_name] = pd.to_datetime(df[field_name]).dt.date
-                elif field_format == 'time':
-                    df[field_name] = pd.to_datetime(df[field_name].astype(str).str.strip(), format='%H:%M:%S').dt.time
-                elif field_type == 'array':
-                    df[field_name] = df[field_name].apply(
-                        lambda x: x if isinstance(x, list) else 
-                        json.loads(x) if isinstance(x, str) and x.strip().startswith('[') else 
-                        [x] if pd.notna(x) else []
-                    )
-                elif field_type == 'boolean':
-                    df[field_name] = df[field_name].map({'true': True, 'false': False})
-                elif field_type in ['number', 'integer']:
-                    df[field_name] = pd.to_numeric(df[field_name], errors='coerce')
-                
-                enum_values = schema_parser.get_enum_values(field_info)
-                if enum_values:
-                    df[field_name] = df[field_name].apply(
-                        lambda x: x if x in enum_values else enum_values[0]
-                    )
+                handler(df, field_name, field_info)
             except Exception as e:
                 print(f"Error processing field '{field_name}': {str(e)}")
                 raise
         
         return df
 
-    def load_data(self, csv_path: str, schema_path: str) -> None:
+    @staticmethod
+    def to_pg_array(value: Any) -> Any:
+        if not isinstance(value, list):
+            return value
+        items = []
+        for item in value:
+            if item is None:
+                items.append('NULL')
+            else:
+                escaped = str(item).replace('\\', '\\\\').replace('"', '\\"')
+                items.append(f'"{escaped}"')
+        return '{' + ','.join(items) + '}'
+
+    def copy_chunk(self, cur, table_name: str, df: pd.DataFrame) -> None:
+        for column in df.columns:
+            if df[column].dtype == object and df[column].map(type).eq(list).any():
+                df[column] = df[column].map(self.to_pg_array)
+        
+        buf = io.StringIO()
+        df.to_csv(buf, index=False, header=False, na_rep='\\N')
+        buf.seek(0)
+        
+        columns = ', '.join(df.columns)
+        cur.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')", buf)
+
+    def load_data(self, csv_path: str, schema_path: str, chunk_size: int = 50000) -> None:
         try:
             schema_parser = SchemaParser(schema_path)
             table_name = re.sub(r'[^a-zA-Z0-9_]', '_', Path(csv_path).stem.lower())
@@ -220,18 +348,33 @@ class GenericDatabaseLoader:
                     
             print(f"Table '{table_name}' created successfully!")
             
-            print(f"\nReading CSV file: {csv_path}")
-            df = pd.read_csv(csv_path, encoding='utf-8')
-            print("\nOriginal columns:")
-            print(df.columns.tolist())
-            
-            print("\nPreparing data...")
-            df = self.prepare_data(df, schema_parser)
-            print("\nProcessed columns and types:")
-            print(df.dtypes)
-            
-            print("\nLoading data into database...")
-            df.to_sql(table_name, self.engine, if_exists='append', index=False, method='multi')
+            print(f"\nStreaming CSV file: {csv_path} ({chunk_size} rows per chunk)")
+            raw = self.engine.raw_connection()
+            try:
+                cur = raw.cursor()
+                csv_dtypes = schema_parser.get_csv_dtypes()
+                chunks = pd.read_csv(csv_path, encoding='utf-8', chunksize=chunk_size, dtype=csv_dtypes)
+                for chunk_number, df in enumerate(chunks):
+                    if chunk_number == 0:
+                        print("\nOriginal columns:")
+                        print(df.columns.tolist())
+                    
+                    df = self.prepare_data(df, schema_parser)
+                    if chunk_number == 0:
+                        print("\nProcessed columns and types:")
+                        print(df.dtypes)
+                        print("\nLoading data into database...")
+                    
+                    self.copy_chunk(cur, table_name, df)
+                    print(f"Chunk {chunk_number + 1}: copied {len(df)} rows")
+                
+                raw.commit()
+                cur.close()
+            except Exception:
+                raw.rollback()
+                raise
+            finally:
+                raw.close()
             print("Data loaded successfully!")
             
             with self.engine.connect() as conn:
@@ -251,10 +394,11 @@ def main():
     parser.add_argument('csv_file', help='Path to the CSV file to load')
     parser.add_argument('schema_file', help='Path to the schema JSON file')
     parser.add_argument('--config', default='config.json', help='Path to database configuration file')
+    parser.add_argument('--chunk-size', type=int, default=50000, help='Number of CSV rows read and copied per chunk')
     args = parser.parse_args()
     
     loader = GenericDatabaseLoader(args.config)
-    loader.load_data(args.csv_file, args.schema_file)
+    loader.load_data(args.csv_file, args.schema_file, chunk_size=args.chunk_size)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
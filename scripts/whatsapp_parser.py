@@ -1,61 +1,97 @@
 import json
 import asyncio
+import csv
+import hashlib
 import aiohttp
-import pandas as pd
+import orjson
 from pathlib import Path
 from typing import Dict, List
 import os
+import random
 import re
-from datetime import datetime
+from datetime import date, datetime, time, timezone
+
+_TS_RE = re.compile(r'\[(\d{2}/\d{2}/\d{4}, \d{2}:\d{2}:\d{2})\]')
+_WS_RE = re.compile(r'\s+')
+# Rate limits, server errors and Anthropic's 529 "overloaded" are worth retrying
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504, 529}
 
 class WhatsAppMessageParser:
-    def __init__(self, api_key: str, schema_file: str, model: str = "claude-3-sonnet-20240229"):
+    def __init__(self, api_key: str, schema_file: str, model: str = "claude-3-sonnet-20240229",
+                 max_concurrency: int = 20, max_retries: int = 6):
         self.api_key = api_key
         self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
         
         # Load schema
-        with open(schema_file, 'r', encoding='utf-8') as f:
-            self.schema = json.load(f)
+        with open(schema_file, 'rb') as f:
+            self.schema = orjson.loads(f.read())
+        
+        # Build the constant parts of every request once
+        self._headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json"
+        }
+        format_description = json.dumps(self.schema['output_format'], indent=2)
+        self._prompt_prefix = f"""{self.schema['system_prompt']}
+
+Expected output format:
+{format_description}
+
+Return ONLY the JSON object matching this format, with no additional text.
+
+Message to analyze:
+"""
             
         self.output_dir = None
         
+    @staticmethod
+    def split_timestamp(stamp: str) -> tuple:
+        """Convert 'DD/MM/YYYY, HH:MM:SS' into date and time objects"""
+        # Fields sit at fixed offsets, so slice instead of re-matching
+        return (
+            date(int(stamp[6:10]), int(stamp[3:5]), int(stamp[0:2])),
+            time(int(stamp[12:14]), int(stamp[15:17]), int(stamp[18:20]))
+        )
+
     def parse_timestamp(self, timestamp_str: str) -> tuple:
         """Parse timestamp string into date and time"""
         # Extract timestamp from format [DD/MM/YYYY, HH:MM:SS]
-        match = re.match(r'\[(\d{2}/\d{2}/\d{4}), (\d{2}:\d{2}:\d{2})\]', timestamp_str)
+        match = _TS_RE.match(timestamp_str)
         if match:
-            date_str, time_str = match.groups()
-            return date_str, time_str
+            try:
+                return self.split_timestamp(match.group(1))
+            except ValueError:
+                pass
         return None, None
 
     def parse_messages(self, text_content: str) -> List[Dict]:
         """Parse text file content into list of messages"""
-        messages = []
+        # Split on timestamps: ['', stamp, body, stamp, body, ...]
+        parts = _TS_RE.split(text_content)
         
-        # Split text into messages (each starting with timestamp)
-        message_pattern = r'(\[\d{2}/\d{2}/\d{4}, \d{2}:\d{2}:\d{2}\].*?)(?=\[\d{2}/\d{2}/\d{4}, \d{2}:\d{2}:\d{2}\]|$)'
-        matches = re.finditer(message_pattern, text_content, re.DOTALL)
+        entries = []
+        for stamp, content in zip(parts[1::2], parts[2::2]):
+            try:
+                message_date, message_time = self.split_timestamp(stamp)
+            except ValueError:
+                # Timestamp-shaped text that is not a real date (e.g. 31/02) belongs to the previous message
+                if entries:
+                    entries[-1][2] += f"[{stamp}]{content}"
+                continue
+            entries.append([message_date, message_time, content])
         
-        for match in matches:
-            message_text = match.group(1).strip()
-            
-            # Extract timestamp and actual message
-            timestamp_end = message_text.find(']') + 1
-            timestamp = message_text[:timestamp_end]
-            content = message_text[timestamp_end:].strip()
-            
-            # Parse timestamp
-            date_str, time_str = self.parse_timestamp(timestamp)
-            
-            if date_str and time_str:
-                messages.append({
-                    'date': date_str,
-                    'time': time_str,
-                    'message': content,
-                    'message_type': 'text'
-                })
-        
-        return messages
+        return [
+            {
+                'date': message_date,
+                'time': message_time,
+                'message': content.strip(),
+                'message_type': 'text'
+            }
+            for message_date, message_time, content in entries
+        ]
 
     def setup_output_directory(self, input_path: str):
         """Create output directory based on input filename"""
@@ -63,67 +99,88 @@ class WhatsAppMessageParser:
         self.output_dir = Path(f"formatted_data_{input_file.stem}")
         self.output_dir.mkdir(parents=True, exist_ok=True)
 
-    async def format_message(self, message: Dict, message_id: str, session: aiohttp.ClientSession) -> Dict:
-        """Format a single message using the schema"""
-        try:
-            headers = {
-                "x-api-key": self.api_key,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json"
-            }
-            
-            # Build complete prompt with format specification
-            format_description = json.dumps(self.schema['output_format'], indent=2)
-            prompt = f"""{self.schema['system_prompt']}
-
-Expected output format:
-{format_description}
-
-Return ONLY the JSON object matching this format, with no additional text.
-
-Message to analyze:
-{message['message']}"""
-            
-            payload = {
-                "model": self.model,
-                "max_tokens": 1024,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            }
+    def build_payload(self, message: Dict) -> Dict:
+        """Build the Messages API request body for a single message"""
+        # Build complete prompt with format specification
+        prompt = self._prompt_prefix + message['message']
+        
+        return {
+            "model": self.model,
+            "max_tokens": 1024,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        }
 
-            async with session.post(
-                "https://api.anthropic.com/v1/messages",
-                headers=headers,
-                json=payload
-            ) as response:
-                if response.status == 429:  # Rate limit
-                    await asyncio.sleep(20)
-                    return await self.format_message(message, message_id, session)
+    def extract_formatted(self, result: Dict, message: Dict, message_id: str) -> Dict:
+        """Turn a Messages API response into the formatted message"""
+        if "content" in result:
+            try:
+                content = result["content"][0]["text"]
+                formatted_data = orjson.loads(content)
+                
+                # Add metadata
+                formatted_data.update({
+                    "date": message["date"],
+                    "time": message["time"],
+                    "original_message": message["message"]
+                })
                 
-                result = await response.json()
+                return formatted_data
                 
-                if "content" in result:
-                    try:
-                        content = result["content"][0]["text"]
-                        formatted_data = json.loads(content)
-                        
-                        # Add metadata
-                        formatted_data.update({
-                            "date": message["date"],
-                            "time": message["time"],
-                            "original_message": message["message"]
-                        })
-                        
-                        return formatted_data
-                        
-                    except (json.JSONDecodeError, KeyError, IndexError) as e:
-                        print(f"Error processing message {message_id}: {str(e)}")
-                        return {}
+            except (orjson.JSONDecodeError, KeyError, IndexError) as e:
+                print(f"Error processing message {message_id}: {str(e)}")
                 return {}
+        return {}
+
+    @staticmethod
+    def retry_delay(headers, attempt: int) -> float:
+        """Seconds to wait after a rate-limited response"""
+        retry_after = headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        
+        reset = headers.get('anthropic-ratelimit-requests-reset')
+        if reset:
+            try:
+                reset_at = datetime.fromisoformat(reset.replace('Z', '+00:00'))
+                delay = (reset_at - datetime.now(timezone.utc)).total_seconds()
+                # A reset time in the past (e.g. clock skew) is no hint at all
+                if delay > 0:
+                    return delay
+            except ValueError:
+                pass
+        
+        # No server hint: exponential backoff with jitter
+        return min(2 ** attempt, 60) + random.uniform(0, 1)
+
+    async def format_message(self, message: Dict, message_id: str, session: aiohttp.ClientSession) -> Dict:
+        """Format a single message using the schema"""
+        try:
+            for attempt in range(self.max_retries):
+                async with session.post(
+                    "https://api.anthropic.com/v1/messages",
+                    headers=self._headers,
+                    json=self.build_payload(message)
+                ) as response:
+                    if response.status == 429:  # Rate limit
+                        delay = self.retry_delay(response.headers, attempt)
+                    else:
+                        result = orjson.loads(await response.read())
+                        return self.extract_formatted(result, message, message_id)
+                
+                # No point waiting if no attempt follows
+                if attempt + 1 < self.max_retries:
+                    await asyncio.sleep(delay)
+            
+            print(f"Error formatting message {message_id}: still rate limited after {self.max_retries} attempts")
+            return {}
                 
         except Exception as e:
             print(f"Error formatting message {message_id}: {str(e)}")
@@ -135,71 +192,222 @@ Message to analyze:
             # Replace newlines with spaces
             text = text.replace('\n', ' ').replace('\r', ' ')
             # Replace multiple spaces with single space
-            text = re.sub(r'\s+', ' ', text)
+            text = _WS_RE.sub(' ', text)
             return text.strip()
         return text
 
     def save_message_json(self, message_data: Dict, message_id: str):
         """Save formatted message as JSON"""
         filename = self.output_dir / f"message_{message_id}.json"
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(message_data, f, ensure_ascii=False, indent=2)
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(message_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
     def save_to_csv(self, formatted_messages: List[Dict], input_name: str):
         """Save all formatted messages to CSV with newlines removed"""
         output_file = self.output_dir / f"{input_name}_formatted.csv"
         
-        # Create a copy of the messages to avoid modifying the original data
-        cleaned_messages = []
-        for message in formatted_messages:
-            cleaned_message = {}
-            for key, value in message.items():
-                if isinstance(value, list):
-                    # Clean each item in the list if it's a string
-                    cleaned_value = [self.clean_text(item) if isinstance(item, str) else item for item in value]
-                    # Join with commas
-                    cleaned_message[key] = ','.join(str(item) for item in cleaned_value)
-                else:
-                    # Clean single value if it's a string
-                    cleaned_message[key] = self.clean_text(value) if isinstance(value, str) else value
-            cleaned_messages.append(cleaned_message)
+        # Union of keys in first-seen order; messages missing a key get an empty cell
+        fieldnames = list(dict.fromkeys(key for message in formatted_messages for key in message))
+        
+        with open(output_file, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, lineterminator='\n')
+            writer.writeheader()
+            for message in formatted_messages:
+                cleaned_message = {}
+                for key, value in message.items():
+                    if isinstance(value, list):
+                        # Join list values with commas, cleaning each string item
+                        value = ','.join(str(self.clean_text(item)) for item in value)
+                    cleaned_message[key] = self.clean_text(value)
+                writer.writerow(cleaned_message)
+
+    def make_message_id(self, message: Dict) -> str:
+        """Build a filename-safe id from the message timestamp and text"""
+        safe_date = message['date'].isoformat()
+        safe_time = message['time'].isoformat().replace(':', '-')
+        # blake2b is stable across runs, unlike the salted built-in hash()
+        message_hash = hashlib.blake2b(message['message'].encode('utf-8'), digest_size=8).hexdigest()
+        return f"{safe_date}_{safe_time}_{message_hash}"
+
+    def create_session(self) -> aiohttp.ClientSession:
+        """Create an HTTP session tuned for the Anthropic API"""
+        # Keep one pooled, keep-alive connection per in-flight request
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrency,
+            limit_per_host=self.max_concurrency,
+            ttl_dns_cache=300,
+            keepalive_timeout=75
+        )
+        timeout = aiohttp.ClientTimeout(total=120, sock_connect=10)
         
-        # Convert to DataFrame and save
-        df = pd.DataFrame(cleaned_messages)
-        df.to_csv(output_file, index=False, encoding='utf-8-sig')
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            json_serialize=lambda obj: orjson.dumps(obj).decode()
+        )
 
     async def process_messages(self, messages: List[Dict], input_path: str):
-        """Process multiple messages in batches"""
+        """Process all messages concurrently, bounded by max_concurrency"""
         self.setup_output_directory(input_path)
-        formatted_messages = []
+        # Results land by input index so the CSV keeps chat order
+        results = [None] * len(messages)
+        sem = asyncio.Semaphore(self.max_concurrency)
+        loop = asyncio.get_running_loop()
         
-        async with aiohttp.ClientSession() as session:
-            batch_size = 5
-            for i in range(0, len(messages), batch_size):
-                batch = messages[i:i + batch_size]
-                batch_tasks = []
-                
-                for msg in batch:
-                    # Create a safe filename by replacing invalid characters
-                    safe_date = msg['date'].replace('/', '-')
-                    safe_time = msg['time'].replace(':', '-')
-                    message_id = f"{safe_date}_{safe_time}_{abs(hash(msg['message']))}"
-                    task = asyncio.create_task(
-                        self.format_message(msg, message_id, session)
-                    )
-                    batch_tasks.append((message_id, task))
-                
-                for message_id, task in batch_tasks:
-                    try:
-                        result = await task
-                        if result:
-                            self.save_message_json(result, message_id)
-                            formatted_messages.append(result)
-                    except Exception as e:
-                        print(f"Error in batch processing: {str(e)}")
-                
-                await asyncio.sleep(0.5)
+        async def bounded(index: int, msg: Dict, message_id: str, session: aiohttp.ClientSession):
+            async with sem:
+                return index, message_id, await self.format_message(msg, message_id, session)
+        
+        async with self.create_session() as session:
+            tasks = [bounded(index, msg, self.make_message_id(msg), session) for index, msg in enumerate(messages)]
+            
+            for coro in asyncio.as_completed(tasks):
+                try:
+                    index, message_id, result = await coro
+                    if result:
+                        # Write off the event loop so in-flight requests keep progressing
+                        await loop.run_in_executor(None, self.save_message_json, result, message_id)
+                        results[index] = result
+                except Exception as e:
+                    print(f"Error in message processing: {str(e)}")
+            
+            formatted_messages = [result for result in results if result]
+            self.save_to_csv(formatted_messages, Path(input_path).stem)
+
+    async def poll_batch(self, session: aiohttp.ClientSession, batch_id: str) -> Dict:
+        """Fetch a batch's status, retrying transient failures"""
+        attempt = 0
+        while True:
+            try:
+                async with session.get(
+                    f"https://api.anthropic.com/v1/messages/batches/{batch_id}",
+                    headers=self._headers
+                ) as response:
+                    body = await response.read()
+                    if response.status == 200:
+                        return orjson.loads(body)
+                    if response.status not in _RETRYABLE_STATUSES:
+                        raise RuntimeError(f"Polling batch {batch_id} failed ({response.status}): {body.decode(errors='replace')}")
+                    print(f"Polling batch {batch_id} returned {response.status}, retrying")
+                    delay = self.retry_delay(response.headers, attempt)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Polling batch {batch_id} failed ({e!r}), retrying")
+                delay = self.retry_delay({}, attempt)
+            
+            # Polling can run for hours, so keep retrying transient errors with capped backoff
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def submit_batch(self, session: aiohttp.ClientSession, requests: List[Dict]) -> Dict:
+        """Create a message batch, retrying when the API is rate limited or overloaded"""
+        for attempt in range(self.max_retries):
+            async with session.post(
+                "https://api.anthropic.com/v1/messages/batches",
+                headers=self._headers,
+                json={"requests": requests}
+            ) as response:
+                body = await response.read()
+                if response.status == 200:
+                    return orjson.loads(body)
+                # Only retry statuses where the batch was certainly not created
+                if response.status not in (429, 529):
+                    raise RuntimeError(f"Batch creation failed ({response.status}): {body.decode(errors='replace')}")
+                delay = self.retry_delay(response.headers, attempt)
+            if attempt + 1 < self.max_retries:
+                await asyncio.sleep(delay)
+        raise RuntimeError(f"Batch creation still rate limited after {self.max_retries} attempts")
+
+    async def collect_batch(self, session: aiohttp.ClientSession, batch: Dict, pending: Dict[str, Dict],
+                            poll_interval: float) -> Dict[str, Dict]:
+        """Wait for a batch to end, then save and return its formatted messages by message id"""
+        loop = asyncio.get_running_loop()
+        while batch.get("processing_status") != "ended":
+            await asyncio.sleep(poll_interval)
+            batch = await self.poll_batch(session, batch["id"])
+            print(f"Batch {batch['id']}: {batch.get('request_counts')}")
+        
+        formatted_messages = {}
+        seen = set()
+        for attempt in range(self.max_retries):
+            try:
+                # Results are JSONL and can be large, so only bound the per-read wait
+                async with session.get(
+                    batch["results_url"],
+                    headers=self._headers,
+                    timeout=aiohttp.ClientTimeout(total=None, sock_read=120)
+                ) as response:
+                    if response.status != 200:
+                        body = await response.read()
+                        if response.status not in _RETRYABLE_STATUSES:
+                            raise RuntimeError(f"Downloading results of batch {batch['id']} failed "
+                                               f"({response.status}): {body.decode(errors='replace')}")
+                        delay = self.retry_delay(response.headers, attempt)
+                    else:
+                        async for line in response.content:
+                            if not line.strip():
+                                continue
+                            entry = orjson.loads(line)
+                            message_id = entry["custom_id"]
+                            # A retried download replays lines that were already handled
+                            if message_id in seen:
+                                continue
+                            seen.add(message_id)
+                            if entry["result"]["type"] != "succeeded":
+                                print(f"Error formatting message {message_id}: {entry['result']}")
+                                continue
+                            
+                            result = self.extract_formatted(entry["result"]["message"], pending[message_id], message_id)
+                            if result:
+                                await loop.run_in_executor(None, self.save_message_json, result, message_id)
+                                formatted_messages[message_id] = result
+                        return formatted_messages
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Downloading results of batch {batch['id']} failed ({e!r}), retrying")
+                delay = self.retry_delay({}, attempt)
+            if attempt + 1 < self.max_retries:
+                await asyncio.sleep(delay)
+        raise RuntimeError(f"Downloading results of batch {batch['id']} failed after {self.max_retries} attempts")
+
+    async def process_messages_batch(self, messages: List[Dict], input_path: str,
+                                     batch_size: int = 10000, poll_interval: float = 30):
+        """Process messages through the Message Batches API"""
+        self.setup_output_directory(input_path)
+        results = {}
+        
+        # custom_id must be unique per batch; identical messages share an id and a result
+        pending = {self.make_message_id(msg): msg for msg in messages}
+        message_ids = list(pending)
+        
+        async with self.create_session() as session:
+            # Submit every batch up front so they are processed in parallel
+            batches = []
+            for start in range(0, len(message_ids), batch_size):
+                batch_ids = message_ids[start:start + batch_size]
+                requests = [
+                    {"custom_id": message_id, "params": self.build_payload(pending[message_id])}
+                    for message_id in batch_ids
+                ]
+                try:
+                    batch = await self.submit_batch(session, requests)
+                except Exception as e:
+                    print(f"Error submitting {len(requests)} messages: {str(e)}")
+                    continue
+                print(f"Submitted batch {batch['id']} with {len(requests)} messages")
+                batches.append(batch)
+            
+            # Poll all batches together; each one is downloaded as soon as it ends
+            outcomes = await asyncio.gather(
+                *(self.collect_batch(session, batch, pending, poll_interval) for batch in batches),
+                return_exceptions=True
+            )
+            for batch, outcome in zip(batches, outcomes):
+                if isinstance(outcome, Exception):
+                    print(f"Error collecting batch {batch['id']}: {str(outcome)}")
+                else:
+                    results.update(outcome)
             
+            # Batches finish, and list their results, in any order; restore chat order
+            formatted_messages = [results[message_id] for message_id in message_ids if message_id in results]
             self.save_to_csv(formatted_messages, Path(input_path).stem)
 
 async def main():
@@ -208,6 +416,8 @@ async def main():
     parser = argparse.ArgumentParser(description='Parse and format WhatsApp messages')
     parser.add_argument('input_file', help='Path to input text file')
     parser.add_argument('schema_file', help='Path to JSON schema file')
+    parser.add_argument('--max-concurrency', type=int, default=20, help='Maximum number of in-flight API requests')
+    parser.add_argument('--batch', action='store_true', help='Use the Message Batches API instead of one request per message')
     args = parser.parse_args()
     
     # Load API key
@@ -216,7 +426,7 @@ async def main():
         raise ValueError("Please set ANTHROPIC_API_KEY environment variable")
     
     # Initialize parser
-    parser = WhatsAppMessageParser(api_key, args.schema_file)
+    parser = WhatsAppMessageParser(api_key, args.schema_file, max_concurrency=args.max_concurrency)
     
     # Read and parse messages
     with open(args.input_file, 'r', encoding='utf-8') as f:
@@ -226,7 +436,10 @@ async def main():
     print(f"Found {len(messages)} messages to process")
     
     # Process messages
-    await parser.process_messages(messages, args.input_file)
+    if args.batch:
+        await parser.process_messages_batch(messages, args.input_file)
+    else:
+        await parser.process_messages(messages, args.input_file)
     print(f"Processed data saved in {parser.output_dir}/")
 
 if __name__ == "__main__":